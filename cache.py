@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shelve
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+import orjson
+
+# Where classify responses are kept between runs
+CACHE_PATH = Path.home() / ".cache" / "zns-describe" / "cache.db"
+
+
+def item_key(item: dict) -> str:
+    """
+    Stable hash of a classify input item, used as its cache key
+    """
+
+    return hashlib.blake2b(orjson.dumps(item, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class ClassifyCache(ABC):
+    """
+    Customs descriptions kept between runs, keyed by item_key
+    """
+
+    @abstractmethod
+    def get_many(self, keys: list[str]) -> dict[str, str]:
+        pass
+
+    def put_many(self, mapping: dict[str, str]) -> None:
+
+        # Missing descriptions aren't stored, so those items get asked for again next time
+        mapping = {key: value for key, value in mapping.items() if value is not None}
+
+        if mapping:
+            self._store(mapping)
+
+    @abstractmethod
+    def _store(self, mapping: dict[str, str]) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DiskCacheBackend(ClassifyCache):
+    """
+    Cache in a local shelve database, only shared between runs on this machine
+    """
+
+    def __init__(self, path: Path = CACHE_PATH):
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.shelf = shelve.open(str(path))
+
+    def get_many(self, keys):
+        return {key: self.shelf[key] for key in set(keys) if key in self.shelf}
+
+    def _store(self, mapping):
+        self.shelf.update(mapping)
+
+    def close(self):
+        self.shelf.close()
+
+
+class RedisBackend(ClassifyCache):
+    """
+    Cache in Redis, shared by everyone pointing at the same server
+    """
+
+    def __init__(self, url: str):
+
+        # Only needed when a shared cache is configured
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def get_many(self, keys):
+
+        keys = list(set(keys))
+
+        if not keys:
+            return {}
+
+        return {
+            key: value.decode()
+            for key, value in zip(keys, self.client.mget(keys))
+            if value is not None
+        }
+
+    def _store(self, mapping):
+        self.client.mset(mapping)
+
+    def close(self):
+        self.client.close()
+
+
+def open_cache() -> ClassifyCache:
+    """
+    Opens the shared Redis cache if ZNS_CACHE_URL is set, otherwise the local one
+    """
+
+    url = os.getenv("ZNS_CACHE_URL")
+
+    if url:
+        return RedisBackend(url)
+
+    return DiskCacheBackend()
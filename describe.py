@@ -1,16 +1,130 @@
 #!/usr/bin/env python
+import csv
 import datetime as dt
-import json
+import glob
+import gzip
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from typing import Union, Optional
 
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
 
-from file_type import infer_file_type
+from cache import ClassifyCache, item_key, open_cache
+from file_type import FileType, infer_file_type
+
+CLASSIFY_URL = "https://classify-gpt3.prod.us-east-2.zdops.net/graphql"
+
+CLASSIFY_QUERY = """mutation GetSimpleClassification($inputs: [ClassificationCalculateInput!]!) {
+    classificationsCalculate(input: $inputs) {
+        id
+        customsDescription
+    }
+}
+"""
+
+# Number of items sent per request, and how many requests are in flight at once
+BATCH_SIZE = 200
+MAX_WORKERS = 8
+
+
+class ConcurrencyLimiter(object):
+    """
+    Caps how many batches are in flight. A rate limit (429) halves the cap for the cooldown,
+    and further 429s during the cooldown only extend it, so the cap goes back to the full
+    limit once the API has been quiet for that long.
+
+    This only holds back batches that haven't started yet. A batch that is already sending
+    keeps its slot while urllib3 sleeps out the Retry-After delay, so the retried requests
+    still wait as long as the API asked before going out again.
+    """
+
+    def __init__(self, limit: int, cooldown: float = 30):
+
+        self.limit = limit
+        self.cooldown = cooldown
+        self.current_limit = limit
+        self._in_flight = 0
+        self._throttled_until = 0.0
+        self._condition = threading.Condition()
+
+    def throttle(self):
+
+        with self._condition:
+
+            # Only halve once per cooldown, a burst of 429s just extends it
+            if time.monotonic() >= self._throttled_until:
+                self.current_limit = max(1, self.limit // 2)
+
+            self._throttled_until = time.monotonic() + self.cooldown
+
+    @contextmanager
+    def slot(self):
+
+        with self._condition:
+
+            # Wait for a free slot, restoring the full limit once the cooldown is over
+            while True:
+                if time.monotonic() >= self._throttled_until:
+                    self.current_limit = self.limit
+                if self._in_flight < self.current_limit:
+                    break
+                self._condition.wait(timeout=1)
+
+            self._in_flight += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+
+class ThrottlingRetry(Retry):
+    """
+    Retry that also tells the limiter whenever the API rate limits us
+    """
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+
+        if response is not None and response.status == 429:
+            LIMITER.throttle()
+
+        return super().increment(method, url, response, *args, **kwargs)
+
+
+LIMITER = ConcurrencyLimiter(MAX_WORKERS)
+
+# Shared session so the concurrent batches reuse pooled connections instead of reconnecting.
+# The pool holds one keep-alive connection per worker so no batch ever opens a throwaway one.
+# POSTs are retried too, waiting as long as the API asks to when it rate limits us.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=MAX_WORKERS,
+        pool_block=True,
+        max_retries=ThrottlingRetry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True,
+        ),
+    ),
+)
 
 
 @contextmanager
@@ -24,42 +138,68 @@ def disable_exception_traceback():
     sys.tracebacklimit = default_value  # revert changes
 
 
-def make_item(row: pd.Series, hs_code_name: str) -> dict:
+def _value_or_none(value):
+    """
+    Empty strings (csv module) and NaN (pandas) both become None, so either reader builds the same item
+    """
 
-    return {
-        "name": row["description"],
-        "description": row["description"],
-        "categories": (
-            row["category"].split(" > ") if row["category"] == row["category"] else None
-        ),
-        "configuration": {"hsCodeProvided": row[hs_code_name].replace(".", "")[:6]},
-    }
+    return value if isinstance(value, (str, list)) and len(value) else None
 
 
-def improve_descriptions_df(df: pd.DataFrame) -> pd.DataFrame:
+def make_items(descriptions, categories, hs_codes) -> list[dict]:
     """
-    Creates an improved item description for a given dataframe
+    Builds the classify input items from already split categories and trimmed hs codes
     """
 
-    file_type = infer_file_type(df)
-    hs_code_name = file_type.get_hs_code_name()
+    items = []
 
-    items = df.apply(lambda row: make_item(row, hs_code_name), axis=1).to_list()
+    for description, category, hs_code in zip(descriptions, categories, hs_codes):
 
-    query = """mutation GetSimpleClassification($inputs: [ClassificationCalculateInput!]!) {
-        classificationsCalculate(input: $inputs) {
-            id
-            customsDescription
-        }
+        description = _value_or_none(description)
+
+        items.append(
+            {
+                "name": description,
+                "description": description,
+                "categories": _value_or_none(category),
+                "configuration": {"hsCodeProvided": _value_or_none(hs_code)},
+            }
+        )
+
+    return items
+
+
+@lru_cache(maxsize=None)
+def _classify_headers() -> dict:
+    """
+    Headers shared by every classify request. Built on first use rather than at import,
+    so a CREDENTIAL_TOKEN loaded from .env after importing this module is still picked up.
+    """
+
+    return {
+        "credentialToken": os.getenv("CREDENTIAL_TOKEN"),
+        "Content-Type": "application/json",
+        "Content-Encoding": "gzip",
+        # Only ask for encodings we can decode (brotli needs the brotli package)
+        **make_headers(accept_encoding=True),
     }
+
+
+def _post_batch(items_chunk: list[dict]) -> list[dict]:
+    """
+    Sends a single chunk of items to the classify endpoint and returns its classifications
     """
 
-    response = requests.post(
-        url="https://classify-gpt3.prod.us-east-2.zdops.net/graphql",
-        json={"query": query, "variables": {"inputs": items}},
-        headers={"credentialToken": os.getenv("CREDENTIAL_TOKEN")},
+    body = gzip.compress(
+        orjson.dumps({"query": CLASSIFY_QUERY, "variables": {"inputs": items_chunk}}),
+        compresslevel=1,
     )
 
+    with LIMITER.slot():
+        response = SESSION.post(
+            url=CLASSIFY_URL, data=body, headers=_classify_headers()
+        )
+
     if response.status_code != 200:
         raise (
             ValueError(
@@ -67,17 +207,109 @@ def improve_descriptions_df(df: pd.DataFrame) -> pd.DataFrame:
             )
         )
 
-    if "data" not in response.json():
+    content = orjson.loads(response.content)
+
+    if "data" not in content:
+        raise (
+            ValueError(
+                f'No data returned\n\n{orjson.dumps(content["errors"], option=orjson.OPT_INDENT_2).decode()})'
+            )
+        )
+
+    classifications = content["data"]["classificationsCalculate"]
+
+    if len(classifications) != len(items_chunk):
         raise (
             ValueError(
-                f'No data returned\n\n{json.dumps(response.json()["errors"],indent=2)})'
+                f"Sent {len(items_chunk)} items but received {len(classifications)} classifications"
             )
         )
 
-    response = response.json()["data"]["classificationsCalculate"]
-    df["Optimized Goods Description"] = [
-        item["customsDescription"] for item in response
-    ]
+    return classifications
+
+
+def classify_items(items: list[dict], classify_cache: ClassifyCache) -> list[str]:
+    """
+    Gets a customs description for each item, only calling the API for items not already cached.
+    The cache is opened once by the caller, since opening it can mean reading its whole index.
+    """
+
+    keys = [item_key(item) for item in items]
+
+    # Pull whatever we've already classified
+    descriptions = classify_cache.get_many(keys)
+
+    # Everything else goes to the API, once per distinct item
+    unique_missing = {
+        key: item for key, item in zip(keys, items) if key not in descriptions
+    }
+    missing_keys = list(unique_missing)
+    missing = list(unique_missing.values())
+
+    # Split the missing items into chunks and classify them concurrently
+    error = None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+
+        futures = {}
+        for i in range(0, len(missing), BATCH_SIZE):
+            future = executor.submit(_post_batch, missing[i : i + BATCH_SIZE])
+            futures[future] = missing_keys[i : i + BATCH_SIZE]
+
+        # Remember each chunk's descriptions as soon as it comes back,
+        # so a failed chunk doesn't throw away the ones that worked
+        for future in as_completed(futures):
+
+            try:
+                response = future.result()
+            except Exception as e:
+
+                # Keep the first error and don't start any more chunks
+                if error is None:
+                    error = e
+                for pending in futures:
+                    pending.cancel()
+                continue
+
+            fresh = {
+                key: item["customsDescription"]
+                for key, item in zip(futures[future], response)
+            }
+            classify_cache.put_many(fresh)
+            descriptions.update(fresh)
+
+    if error is not None:
+        raise error
+
+    return [descriptions[key] for key in keys]
+
+
+def improve_descriptions_df(
+    df: pd.DataFrame, file_type: Optional[FileType] = None
+) -> pd.DataFrame:
+    """
+    Creates an improved item description for a given dataframe.
+    Pass the file type returned by validate_input_file to avoid inferring it again.
+    """
+
+    if file_type is None:
+        file_type = infer_file_type(df)
+
+    hs_code_name = file_type.hs_code_name
+
+    # Prepare each column as a whole rather than row by row
+    descriptions = df["description"].to_numpy()
+    categories = (
+        df["category"].str.split(" > ").where(df["category"].notna(), None).to_numpy()
+    )
+    hs_codes = (
+        df[hs_code_name].str.replace(".", "", regex=False).str.slice(0, 6).to_numpy()
+    )
+
+    items = make_items(descriptions, categories, hs_codes)
+
+    with open_cache() as classify_cache:
+        df["Optimized Goods Description"] = classify_items(items, classify_cache)
 
     return df
 
@@ -97,9 +329,19 @@ def get_output_file(
             input_file.stem + "-with-descriptions" + input_file.suffix
         )
 
+        # List the previous outputs once instead of checking each name on disk
+        existing = {
+            path.name
+            for path in input_file.parent.glob(
+                glob.escape(input_file.stem)
+                + "-with-descriptions*"
+                + glob.escape(input_file.suffix)
+            )
+        }
+
         # If it exists, add a number at the end until it doesn't exist
         n = 0
-        while output_file.exists():
+        while output_file.name in existing:
             output_file = input_file.with_name(
                 input_file.stem + f"-with-descriptions-{n}" + input_file.suffix
             )
@@ -123,14 +365,18 @@ def get_output_file(
     return output_file
 
 
-def validate_input_file(df: pd.DataFrame) -> bool:
+def validate_input_file(df: pd.DataFrame) -> FileType:
     """
-    Make sure the input file has all the right columns
+    Make sure the input file has all the right columns, returning its file type
     """
 
     # Define the required columns
     file_type = infer_file_type(df)
 
+    # Yell if it doesn't look like any file we know about
+    if file_type is None:
+        raise (ValueError("Input file does not match any known file type"))
+
     # Calculate the missing columns
     missing_cols = file_type.missing_cols()
 
@@ -139,7 +385,7 @@ def validate_input_file(df: pd.DataFrame) -> bool:
         raise (ValueError(f"Input file is missing columns {missing_cols}"))
 
     # Make sure we have an hs_code column
-    hs_code_col = file_type.get_hs_code_name()
+    hs_code_col = file_type.hs_code_name
 
     if hs_code_col is None:
         raise (
@@ -148,7 +394,108 @@ def validate_input_file(df: pd.DataFrame) -> bool:
             )
         )
 
-    return True
+    return file_type
+
+
+def stream_describe(
+    input_path: Union[str, Path],
+    output_path: Union[str, Path],
+    batch_size: int = BATCH_SIZE * MAX_WORKERS,
+) -> None:
+    """
+    Describes a CSV one batch of rows at a time, so only a few batches are ever held in memory.
+    The default batch size gives every worker a full chunk to classify.
+    """
+
+    # Only the header is needed to make sure the input file is what we expect
+    header = pd.read_csv(input_path, dtype=str, nrows=0)
+    hs_code_name = validate_input_file(header).hs_code_name
+
+    # Write next to the output and only move it into place once every row is described,
+    # so a failed run doesn't leave a partial output file behind
+    output_path = Path(output_path)
+    partial_path = output_path.with_name(f".{output_path.name}.partial")
+
+    try:
+        with open(input_path, newline="", encoding="utf-8-sig") as f_in, open(
+            partial_path, "w", newline="", encoding="utf-8"
+        ) as f_out, open_cache() as classify_cache:
+
+            # Rows stay plain lists so every input field is written back exactly as it was read,
+            # with only the new column appended
+            reader = csv.reader(f_in)
+            columns = next(reader)
+            writer = csv.writer(f_out, lineterminator="\n")
+            writer.writerow(columns + ["Optimized Goods Description"])
+
+            description_col = columns.index("description")
+            category_col = columns.index("category")
+            hs_code_col = columns.index(hs_code_name)
+
+            def read_rows():
+
+                for row in reader:
+
+                    # Skip blank lines, like csv.DictReader and pandas do
+                    if not row:
+                        continue
+
+                    if len(row) > len(columns):
+                        raise (
+                            ValueError(
+                                f"Line {reader.line_num} of the input file has {len(row)} fields, expected {len(columns)}"
+                            )
+                        )
+
+                    # Fill in missing trailing fields so the new column lines up
+                    yield row + [""] * (len(columns) - len(row))
+
+            rows_in = read_rows()
+
+            def read_batch() -> list[list[str]]:
+                return list(islice(rows_in, batch_size))
+
+            # Read the next batch and write the previous one while the current one is classified.
+            # Only one read and one write are ever outstanding, so rows stay in order.
+            with ThreadPoolExecutor(max_workers=2) as io:
+
+                next_batch = io.submit(read_batch)
+                pending_write = None
+
+                while batch := next_batch.result():
+
+                    next_batch = io.submit(read_batch)
+
+                    items = make_items(
+                        [row[description_col] for row in batch],
+                        [
+                            (
+                                row[category_col].split(" > ")
+                                if row[category_col]
+                                else None
+                            )
+                            for row in batch
+                        ],
+                        [row[hs_code_col].replace(".", "")[:6] for row in batch],
+                    )
+                    rows = [
+                        row + [description]
+                        for row, description in zip(
+                            batch, classify_items(items, classify_cache)
+                        )
+                    ]
+
+                    if pending_write is not None:
+                        pending_write.result()
+                    pending_write = io.submit(writer.writerows, rows)
+
+                if pending_write is not None:
+                    pending_write.result()
+
+        os.replace(partial_path, output_path)
+
+    finally:
+        partial_path.unlink(missing_ok=True)
 
 
 def cli(input_file, output_file, force: bool):
@@ -159,20 +506,11 @@ def cli(input_file, output_file, force: bool):
     # Get the output file
     output_file = get_output_file(input_file, output_file, overwrite_existing=force)
 
-    # Read the input file
-    df = pd.read_csv(input_file, dtype=str)
-
-    # Make sure the input file is what we expect
-    validate_input_file(df)
-
-    # Improve the descriptions
+    # Improve the descriptions, streaming the input file into the output file
     t_start = dt.datetime.now()
-    df = improve_descriptions_df(df)
+    stream_describe(input_file, output_file)
     t_end = dt.datetime.now()
 
-    # Save the file
-    df.to_csv(output_file, index=False)
-
     # Print the elapsed time
     print(f"Elapsed time: {t_end-t_start}")
 
@@ -184,20 +522,11 @@ def debug(input_file, output_file=None, force: bool = False):
     # Get the output file
     output_file = get_output_file(input_file, output_file, overwrite_existing=force)
 
-    # Read the input file
-    df = pd.read_csv(input_file, dtype=str)
-
-    # Make sure the input file is what we expect
-    validate_input_file(df)
-
-    # Improve the descriptions
+    # Improve the descriptions, streaming the input file into the output file
     t_start = dt.datetime.now()
-    df = improve_descriptions_df(df)
+    stream_describe(input_file, output_file)
     t_end = dt.datetime.now()
 
-    # Save the file
-    df.to_csv(output_file, index=False)
-
     # Print the elapsed time
     print(f"Elapsed time: {t_end-t_start}")
 
@@ -220,14 +549,11 @@ def describe(
     df = pd.read_csv(input_file, dtype=str)
 
     # make sure the input file is what we expect
-    validated = validate_input_file(df)
-
-    if not validated:
-        raise (ValueError("Input file failed validation."))
+    file_type = validate_input_file(df)
 
     # Improve the descriptions
     t_start = dt.datetime.now()
-    df = improve_descriptions_df(df)
+    df = improve_descriptions_df(df, file_type)
     t_end = dt.datetime.now()
 
     # save the file
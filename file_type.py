@@ -1,95 +1,75 @@
+from functools import cached_property
+from typing import Optional
+
 import pandas as pd
 
 
 class FileType(object):
-    def __init__(self, data: pd.DataFrame):
-
-        self.data = data
 
-    def missing_cols(self) -> list[str]:
-
-        return list(set(self.item_cols) - set(self.data.columns.tolist()))
-
-    def fits_type(self) -> bool:
-        return len(self.missing_cols()) == 0
+    # Columns a file of this type must have. Each subclass sets UNNAMED_COLS and NAMED_COLS,
+    # and ITEM_COLS is derived from them. The base class has none, so it can't be matched to a file.
+    UNNAMED_COLS: list[str]
+    NAMED_COLS: list[str]
+    ITEM_COLS: frozenset[str]
 
-    @property
-    def item_cols(self) -> list[str]:
-        raise (NotImplementedError)
+    def __init_subclass__(cls, **kwargs):
 
-    @property
-    def unnamed_cols(self) -> list[str]:
-        raise (NotImplementedError)
+        super().__init_subclass__(**kwargs)
 
-    @property
-    def named_cols(self) -> list[str]:
-        raise (NotImplementedError)
+        cls.ITEM_COLS = frozenset(cls.UNNAMED_COLS + cls.NAMED_COLS)
 
-    def get_hs_code_name(self) -> str:
-        raise (NotImplementedError)
+    def __init__(self, data: pd.DataFrame):
 
+        self.data = data
 
-class BulkClassifyOutput(FileType):
-    @property
-    def item_cols(self):
-        return self.unnamed_cols + self.named_cols
+    @classmethod
+    def fits_columns(cls, columns: frozenset[str]) -> bool:
+        return cls.ITEM_COLS.issubset(columns)
 
-    @property
-    def unnamed_cols(self):
-        return ["Description", "Detailed Description"]
+    def missing_cols(self) -> list[str]:
 
-    @property
-    def named_cols(self):
-        return ["Category", "Brand", "Material/Composition"]
+        return list(self.ITEM_COLS.difference(self.data.columns))
 
-    def get_hs_code_name(self):
+    def fits_type(self) -> bool:
+        return self.fits_columns(frozenset(self.data.columns))
 
-        # Loop over columns
-        for col in self.data.columns:
+    def get_hs_code_name(self) -> Optional[str]:
 
-            # Does it start with "hs_code"
-            if col.startswith("hs_code"):
+        # Columns that start with "hs_code"
+        matches = self.data.columns[self.data.columns.str.startswith("hs_code")]
 
-                # That's the one
-                return col
+        # The first one is the one, if there are any
+        return matches[0] if len(matches) else None
 
-        # You didn't find any
-        return None
+    @cached_property
+    def hs_code_name(self) -> Optional[str]:
+        """
+        The hs_code column name, only looked up once per file
+        """
 
+        return self.get_hs_code_name()
 
-class ColinaBoardOutput(FileType):
-    @property
-    def item_cols(self):
-        return self.unnamed_cols + self.named_cols
 
-    @property
-    def unnamed_cols(self):
-        return ["description", "detailedDescription"]
+class BulkClassifyOutput(FileType):
 
-    @property
-    def named_cols(self):
-        return ["category"]
+    UNNAMED_COLS = ["Description", "Detailed Description"]
+    NAMED_COLS = ["Category", "Brand", "Material/Composition"]
 
-    def get_hs_code_name(self):
 
-        # Loop over columns
-        for col in self.data:
+class ColinaBoardOutput(FileType):
 
-            # Does it start with "hs_code"
-            if col.startswith("hs_code"):
+    UNNAMED_COLS = ["description", "detailedDescription"]
+    NAMED_COLS = ["category"]
 
-                # That's the one
-                return col
 
-        # You didn't find any
-        return None
+FILE_TYPES = [BulkClassifyOutput, ColinaBoardOutput]
 
 
-def infer_file_type(data: pd.DataFrame) -> FileType:
+def infer_file_type(data: pd.DataFrame) -> Optional[FileType]:
 
-    file_types = [BulkClassifyOutput, ColinaBoardOutput]
+    # Check the columns against each type, only building the one that matches
+    columns = frozenset(data.columns)
 
-    for ft in file_types:
-        candidate = ft(data)
-        if candidate.fits_type():
-            return candidate
+    for ft in FILE_TYPES:
+        if ft.fits_columns(columns):
+            return ft(data)